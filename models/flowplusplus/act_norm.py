@@ -20,6 +20,8 @@ class _BaseNorm(nn.Module):
         num_channels *= 2
 
         self.register_buffer('is_initialized', torch.zeros(1))
+        # Host-side copy of `is_initialized`, so forward doesn't sync with the device
+        self._initialized = False
         self.mean = nn.Parameter(torch.zeros(1, num_channels, height, width))
         self.inv_std = nn.Parameter(torch.zeros(1, num_channels, height, width))
         self.eps = 1e-6
@@ -34,6 +36,10 @@ class _BaseNorm(nn.Module):
             self.inv_std.data.copy_(inv_std.data)
             self.is_initialized += 1.
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        super(_BaseNorm, self)._load_from_state_dict(*args, **kwargs)
+        self._initialized = False
+
     def _center(self, x, reverse=False):
         if reverse:
             return x + self.mean
@@ -48,8 +54,10 @@ class _BaseNorm(nn.Module):
 
     def forward(self, x, ldj=None, reverse=False):
         x = torch.cat(x, dim=1)
-        if not self.is_initialized:
-            self.initialize_parameters(x)
+        if not self._initialized:
+            if not self.is_initialized:
+                self.initialize_parameters(x)
+            self._initialized = bool(self.is_initialized)
 
         if reverse:
             x, ldj = self._scale(x, ldj, reverse)
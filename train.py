@@ -3,6 +3,8 @@
 Train script adapted from: https://github.com/kuangliu/pytorch-cifar/
 """
 import argparse
+import contextlib
+import concurrent.futures
 import numpy as np
 import os
 import random
@@ -10,50 +12,125 @@ import torch
 import torch.optim as optim
 import torch.optim.lr_scheduler as sched
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.utils.data as data
 import torchvision
 import torchvision.transforms as transforms
-from torch.distributions import Independent, Normal
 
 import util
+from vae_cache import VAECachedCIFAR10, build_vae_cache, cache_dir_for, is_cache_valid
 from vae_n_d_n_l import VAE
 from models import FlowPlusPlus
 from tqdm import tqdm
 
+# Writes checkpoints and images in the background, so the next epoch can start right away
+io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+io_futures = []
 
-def main(args):
-    # Set up main device and scale batch size
-    device = 'cuda' if torch.cuda.is_available() and args.gpu_ids else 'cpu'
-    print(device)
-    args.batch_size *= max(1, len(args.gpu_ids))
-
-    # Set random seeds
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed_all(args.seed)
-
-    # No normalization applied, since model expects inputs in (0, 1)
-    transform_train = transforms.Compose([
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor()
-    ])
 
-    transform_test = transforms.Compose([
-        transforms.ToTensor()
-    ])
+def submit_io(fn, *args):
+    """Run `fn(*args)` on `io_pool`. Errors of earlier writes that have
+    finished in the meantime are raised here, instead of being dropped."""
+    for future in [f for f in io_futures if f.done()]:
+        io_futures.remove(future)
+        future.result()
+    io_futures.append(io_pool.submit(fn, *args))
+
 
-    trainset = torchvision.datasets.CIFAR10(root='data', train=True, download=True, transform=transform_train)
-    trainloader = data.DataLoader(trainset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+def wait_io():
+    """Wait for all pending writes, raising the first error if any failed."""
+    while io_futures:
+        io_futures.pop(0).result()
 
-    testset = torchvision.datasets.CIFAR10(root='data', train=False, download=True, transform=transform_test)
-    testloader = data.DataLoader(testset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+def main(args):
+    # Set up main device. Under `torchrun` each process drives one GPU,
+    # so `batch_size` stays per GPU and LR/warm-up scale with the world size
+    num_gpus = len(args.gpu_ids)
+    assert num_gpus <= 1 or 'WORLD_SIZE' in os.environ, \
+        'Error: {} GPUs need one process each, launch with torchrun --nproc_per_node={}!'.format(num_gpus, num_gpus)
+    rank, local_rank, world_size = util.init_distributed()
+    device = 'cuda' if torch.cuda.is_available() and args.gpu_ids else 'cpu'
+    print(device)
+    args.lr *= world_size
+    args.warm_up *= world_size
+
+    # Set random seeds, offset by rank so that processes draw different
+    # dropout masks, dequantization noise and flips
+    seed = args.seed + rank
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    if args.benchmark:
+        # Autotune each conv shape once, then reuse the fastest kernel
+        cudnn.benchmark = True
+        cudnn.deterministic = False
+    else:
+        # Reproducible kernels instead of the fastest ones
+        os.environ.setdefault('CUBLAS_WORKSPACE_CONFIG', ':4096:8')
+        cudnn.benchmark = False
+        torch.use_deterministic_algorithms(True, warn_only=True)
+
+    # Let fp32 convs/matmuls run on tensor cores
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     # Model vae
     vae_net = VAE('cifar')
     vae_net.init_model()
-    vae_net.load_state_dict(torch.load(args.vae_model_path))
+    vae_net.load_state_dict(torch.load(args.vae_model_path, map_location=device))
     vae_net.eval()
+    # The VAE is frozen, so keep autograd out of it
+    vae_net.requires_grad_(False)
+
+    # No normalization applied, since model expects inputs in (0, 1).
+    # Images stay uint8 until they are on the device, and training images
+    # are randomly flipped there, see train/test
+    transform = transforms.Compose([
+        util.ToUint8Tensor()
+    ])
+
+    # Pinned host memory lets the `non_blocking` copies in train/test overlap with compute
+    loader_kwargs = {'num_workers': args.num_workers, 'pin_memory': device == 'cuda'}
+    if args.num_workers > 0:
+        # Each worker keeps `prefetch_factor` batches in (pinned) host memory
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+
+    # Rank 0 downloads CIFAR-10 (and builds the VAE cache) while the others wait,
+    # so processes don't race to write the same files
+    cache_dir = cache_dir_for(args.vae_cache_dir, args.vae_model_path)
+    if util.is_main_process():
+        for is_train in (True, False):
+            torchvision.datasets.CIFAR10(root='data', train=is_train, download=True)
+        if args.use_vae_cache and not is_cache_valid(cache_dir, args.vae_model_path):
+            # Posteriors of the frozen VAE (and of the flipped images) are computed once,
+            # and again whenever the VAE weights change
+            print('Caching VAE posteriors in {}...'.format(cache_dir))
+            build_vae_cache(vae_net, args.vae_model_path, 'data', cache_dir, device)
+    if dist.is_initialized():
+        dist.barrier()
+
+    if args.use_vae_cache:
+        trainset = VAECachedCIFAR10(root='data', cache_dir=cache_dir, train=True, transform=transform)
+        testset = VAECachedCIFAR10(root='data', cache_dir=cache_dir, train=False, transform=transform)
+    else:
+        trainset = torchvision.datasets.CIFAR10(root='data', train=True, transform=transform)
+        testset = torchvision.datasets.CIFAR10(root='data', train=False, transform=transform)
+    if args.use_amp and device == 'cuda':
+        # Cast after building the cache, so cached posteriors keep full precision
+        vae_net.to(dtype=torch.bfloat16)
+
+    if world_size > 1:
+        train_sampler = data.DistributedSampler(trainset, shuffle=True)
+        test_sampler = util.ShardedSampler(testset)
+    else:
+        train_sampler = data.RandomSampler(trainset)
+        test_sampler = data.SequentialSampler(testset)
+
+    trainloader = data.DataLoader(trainset, batch_size=args.batch_size, sampler=train_sampler, drop_last=True,
+                                  **loader_kwargs)
+    testloader = data.DataLoader(testset, batch_size=args.batch_size, sampler=test_sampler, **loader_kwargs)
 
     # Model flow++
     print('Building model..')
@@ -65,18 +142,34 @@ def main(args):
                        num_components=args.num_components,
                        use_attn=args.use_attn,
                        drop_prob=args.drop_prob)
-    net = net.to(device)
-    if device == 'cuda':
-        net = torch.nn.DataParallel(net, args.gpu_ids)
-        cudnn.benchmark = args.benchmark
+    # NHWC lets cuDNN pick its tensor-core conv kernels
+    net = net.to(device, memory_format=torch.channels_last)
+    if args.use_compile and device == 'cuda' and hasattr(torch.nn.Module, 'compile'):
+        # Fuse the flow's small elementwise ops. Compiled in place so that
+        # parameter names (and checkpoints) are unchanged. CUDA graphs are
+        # left out, since they don't mix with the VAE's side stream
+        net.compile(mode='max-autotune-no-cudagraphs')
+        vae_net.decode_params = torch.compile(vae_net.decode_params)
+    if world_size > 1:
+        # ActNorm initializes its parameters from the first training batch. Do that
+        # before wrapping, so DDP's constructor copies rank 0's init to every rank
+        net.train()
+        with torch.no_grad():
+            x, _, *posterior = next(iter(trainloader))
+            x, _ = random_flip(*to_device(x, posterior, device))
+            net(x, reverse=False)
+        net = torch.nn.parallel.DistributedDataParallel(net, device_ids=[local_rank], output_device=local_rank,
+                                                        find_unused_parameters=False,
+                                                        gradient_as_bucket_view=True)
 
     start_epoch = 0
     if args.resume:
         # Load checkpoint.
         print('Resuming from checkpoint at save/best.pth.tar...')
         assert os.path.isdir('save'), 'Error: no checkpoint directory found!'
-        checkpoint = torch.load('save/best.pth.tar')
-        net.load_state_dict(checkpoint['net'])
+        checkpoint = torch.load('save/best.pth.tar', map_location=device)
+        model = net.module if isinstance(net, torch.nn.parallel.DistributedDataParallel) else net
+        model.load_state_dict(checkpoint['net'])
         global best_loss
         global global_step
         best_loss = checkpoint['test_loss']
@@ -85,93 +178,257 @@ def main(args):
 
     loss_fn = util.NLLLoss().to(device)
     param_groups = util.get_param_groups(net, args.weight_decay, norm_suffix='weight_g')
-    optimizer = optim.Adam(param_groups, lr=args.lr)
+    # Update all parameters with one fused kernel (multi-tensor `foreach` path on CPU)
+    adam_impl = {'fused': True} if device == 'cuda' else {'foreach': True}
+    lr = args.lr
+    if args.use_cuda_graph:
+        assert device == 'cuda' and world_size == 1 and args.grad_accum_steps == 1, \
+            'Error: CUDA graphs need a single GPU and no gradient accumulation!'
+        # Keep step count and LR on the device, so the captured step sees their updates
+        adam_impl['capturable'] = True
+        lr = torch.tensor(args.lr, device=device)
+    optimizer = optim.Adam(param_groups, lr=lr, **adam_impl)
+    for group in optimizer.param_groups:
+        # Keep the scheduler's base LR apart from the (possibly shared) LR tensor it updates
+        group['initial_lr'] = args.lr
     warm_up = args.warm_up * args.batch_size
     scheduler = sched.LambdaLR(optimizer, lambda s: min(1., s / warm_up))
+    use_amp = args.use_amp and device == 'cuda'
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+    vae_stream = torch.cuda.Stream() if device == 'cuda' else None
+
+    graphed_step = None
+    if args.use_cuda_graph:
+        # bf16 needs no loss scaling, and GradScaler would sync inside the graph
+        def train_step(x, *posterior):
+            loss = compute_loss(net, vae_net, x, posterior, loss_fn, use_amp)
+            loss.backward()
+            if args.max_grad_norm > 0:
+                clip_grad_norm(optimizer, args.max_grad_norm)
+            optimizer.step()
+            return loss.detach()
+
+        print('Capturing training step in a CUDA graph...')
+        net.train()
+        x, _, *posterior = next(iter(trainloader))
+        x, posterior = random_flip(*to_device(x, posterior, device))
+        graphed_step = util.CUDAGraphStep(train_step, optimizer, [x, *posterior])
+        vae_stream = None
 
     for epoch in range(start_epoch, start_epoch + args.num_epochs):
+        if isinstance(train_sampler, data.DistributedSampler):
+            train_sampler.set_epoch(epoch)
         train(epoch, net, vae_net,  trainloader, device, optimizer, scheduler,
-              loss_fn, args.max_grad_norm)
-        test(epoch, net, vae_net, testloader, device, loss_fn, args.num_samples, args.save_dir)
+              loss_fn, args.max_grad_norm, scaler, args.grad_accum_steps, vae_stream, args.log_interval,
+              graphed_step)
+        test(epoch, net, vae_net, testloader, device, loss_fn, args.num_samples, args.save_dir, vae_stream,
+             args.log_interval, args.save_recon_every)
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 
 @torch.enable_grad()
-def train(epoch, net, vae_net, trainloader, device, optimizer, scheduler, loss_fn, max_grad_norm):
+def train(epoch, net, vae_net, trainloader, device, optimizer, scheduler, loss_fn, max_grad_norm, scaler,
+          grad_accum_steps=1, vae_stream=None, log_interval=50, graphed_step=None):
     global global_step
-    print('\nEpoch: %d' % epoch)
+    if util.is_main_process():
+        print('\nEpoch: %d' % epoch)
     net.train()
     loss_meter = util.AverageMeter()
-    with tqdm(total=len(trainloader.dataset)) as progress_bar:
-        for x, _ in trainloader:
-            x = x.to(device)
-            optimizer.zero_grad()
+    world_size = util.get_world_size()
+    with tqdm(total=len(trainloader.sampler), disable=not util.is_main_process()) as progress_bar:
+        for step, (x, _, *posterior) in enumerate(trainloader):
+            x, posterior = random_flip(*to_device(x, posterior, device))
+
+            if graphed_step is not None:
+                # Forward, backward and optimizer step in a single replay
+                loss_meter.update(graphed_step(x, *posterior), x.size(0))
+                scheduler.step(global_step)
+                graphed_step.sync_lr()
+            else:
+                # Only all-reduce gradients on the last micro-batch of each accumulation round
+                do_step = (step + 1) % grad_accum_steps == 0 or step + 1 == len(trainloader)
+                if not do_step and isinstance(net, torch.nn.parallel.DistributedDataParallel):
+                    sync_context = net.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
+
+                with sync_context:
+                    loss = compute_loss(net, vae_net, x, posterior, loss_fn, scaler.is_enabled(), vae_stream)
+                    loss_meter.update(loss, x.size(0))
+                    scaler.scale(loss / grad_accum_steps).backward()
+
+                if do_step:
+                    if max_grad_norm > 0:
+                        scaler.unscale_(optimizer)
+                        clip_grad_norm(optimizer, max_grad_norm)
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+                    scheduler.step(global_step)
+
+            # Reading `loss_meter.avg` syncs with the GPU, so only do it every few steps
+            if step % log_interval == 0 or step + 1 == len(trainloader):
+                progress_bar.set_postfix(nll=loss_meter.avg,
+                                         bpd=util.bits_per_dim(x, loss_meter.avg),
+                                         lr=float(optimizer.param_groups[0]['lr']))
+            progress_bar.update(x.size(0))
+            global_step += x.size(0) * world_size
 
-            # vae model both n
-            mu_d, logvar_d, mu, logvar = vae_net(x)
 
-            z, sldj = net(x, reverse=False)
+def clip_grad_norm(optimizer, max_norm):
+    """Clip the global gradient norm of all parameters under `optimizer`,
+    using the multi-tensor kernels for the norm and the rescaling."""
+    params = [p for group in optimizer.param_groups for p in group['params']]
+    torch.nn.utils.clip_grad_norm_(params, max_norm, foreach=True)
 
-            # loss = loss_fn(z, sldj)
-            loss = loss_fn(z, sldj, mu_d, logvar_d)
 
-            loss_meter.update(loss.item(), x.size(0))
-            loss.backward()
-            if max_grad_norm > 0:
-                util.clip_grad_norm(optimizer, max_grad_norm)
-            optimizer.step()
-            scheduler.step(global_step)
+def to_device(x, posterior, device):
+    """Copy a uint8 batch (and its cached VAE posterior) to `device`, then
+    convert the images to channels-last floats in (0, 1) there."""
+    x = x.to(device, non_blocking=True)
+    x = x.to(dtype=torch.float32, memory_format=torch.channels_last).div_(255.)
+    posterior = [t.to(device, non_blocking=True) for t in posterior]
 
-            progress_bar.set_postfix(nll=loss_meter.avg,
-                                     bpd=util.bits_per_dim(x, loss_meter.avg),
-                                     lr=optimizer.param_groups[0]['lr'])
-            progress_bar.update(x.size(0))
-            global_step += x.size(0)
+    return x, posterior
 
 
-@torch.no_grad()
-def sample(net, vae_net, batch_size, device):
-    # assume latent features space ~ N(0, 1)
-    z = torch.randn(batch_size, vae_net.n_latent_features).to(device)
-    z = vae_net.fc4(z)
-    z = vae_net.decoder(z)
-    z = z.view(-1, vae_net.n_neurons_last_decoder_layer)
+def random_flip(x, posterior=()):
+    """Flip each image in `x` horizontally with probability 0.5.
 
-    """ both normal """
-    mu_d, logvar_d = vae_net.decoder_bottleneck(z)
-    dist = Independent(Normal(loc=mu_d, scale=torch.exp(logvar_d)), 1)
+    Done on the device in one pass for the whole batch. Cached posteriors of
+    shape (B, 2, D) are reduced to the (B, D) posteriors of the chosen images.
+    """
+    flip = torch.rand(x.size(0), device=x.device) < 0.5
+    x = torch.where(flip.view(-1, 1, 1, 1), torch.flip(x, dims=[-1]), x)
+    posterior = [torch.where(flip.view(-1, 1), t[:, 1], t[:, 0]) for t in posterior]
 
-    # sample from model
-    z = dist.sample()
-    z = z.view(-1, 3, 32, 32)
+    return x, posterior
 
-    x, _ = net(z, reverse=True)
-    x = torch.sigmoid(x)
-    return x
 
+def compute_loss(net, vae_net, x, posterior, loss_fn, use_amp=False, vae_stream=None):
+    """Get the NLL of the batch `x` under the flow with the VAE prior."""
+    # Convs/matmuls run in bf16, the likelihood is evaluated in fp32
+    with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_amp):
+        # vae model both n
+        mu_d, logvar_d = run_vae(vae_net, x, posterior, vae_stream)
 
-@torch.no_grad()
-def test(epoch, net, vae_net, testloader, device, loss_fn, num_samples, save_dir):
-    global best_loss
-    net.eval()
-    loss_meter = util.AverageMeter()
-    with tqdm(total=len(testloader.dataset)) as progress_bar:
-        for x, _ in testloader:
-            x = x.to(device)
+        z, sldj = net(x, reverse=False)
+        if vae_stream is not None:
+            torch.cuda.current_stream().wait_stream(vae_stream)
+
+    # loss = loss_fn(z, sldj)
+    loss = loss_fn(z.float(), sldj.float(), mu_d.float(), logvar_d.float())
 
-            # vae model
-            mu_d, logvar_d, mu, logvar = vae_net(x)
+    return loss
 
-            z, sldj = net(x, reverse=False)
-            # loss = loss_fn(z, sldj)
-            loss = loss_fn(z, sldj, mu_d, logvar_d)
 
-            loss_meter.update(loss.item(), x.size(0))
-            progress_bar.set_postfix(nll=loss_meter.avg,
-                                     bpd=util.bits_per_dim(x, loss_meter.avg))
+def run_vae(vae_net, x, posterior=(), stream=None):
+    """Launch `vae_net` on `x`, on a side CUDA stream if `stream` is given.
+
+    If the cached posterior `(mu, logvar)` of `x` is given, the encoder is
+    skipped and only the latent sample and decoder are run. Inputs are cast
+    to the dtype of `vae_net`, and the returned `(mu_d, logvar_d)` are left
+    in that dtype.
+
+    The VAE only shares its input with the flow, so running it on another
+    stream lets its kernels overlap with the flow's. The caller must make
+    the current stream wait on `stream` before using the outputs.
+    """
+    dtype = next(vae_net.parameters()).dtype
+
+    def forward():
+        if posterior:
+            return vae_net.decode_params(*(t.to(dtype) for t in posterior))
+        return vae_net(x.to(dtype), return_posterior=False)
+
+    if stream is None:
+        return forward()
+
+    current_stream = torch.cuda.current_stream()
+    stream.wait_stream(current_stream)
+    with torch.cuda.stream(stream):
+        outputs = forward()
+
+    # Keep the caching allocator from recycling memory still in use on the other stream
+    for t in [x, *posterior]:
+        t.record_stream(stream)
+    for t in outputs:
+        t.record_stream(current_stream)
+
+    return outputs
+
+
+@torch.inference_mode()
+def sample(net, vae_net, batch_size, device, chunk_size=None):
+    """Draw `batch_size` samples, `chunk_size` at a time to bound the memory
+    of the inverse flow. Returns the samples on the CPU."""
+    chunk_size = chunk_size or batch_size
+    dtype = next(vae_net.parameters()).dtype
+    outs = []
+    for i in range(0, batch_size, chunk_size):
+        # assume latent features space ~ N(0, 1)
+        z = torch.randn(min(chunk_size, batch_size - i), vae_net.n_latent_features, device=device, dtype=dtype)
+        z = vae_net.fc4(z)
+        z = vae_net.decoder(z)
+        z = z.view(-1, vae_net.n_neurons_last_decoder_layer)
+
+        """ both normal """
+        mu_d, logvar_d = vae_net.decoder_bottleneck(z)
+        mu_d, logvar_d = mu_d.float(), logvar_d.float()
+
+        # sample from model (reparameterized, no Distribution object needed).
+        # The decoder's `logvar_d` is log sigma, not log sigma^2, as in `NLLLoss`
+        scale = torch.exp(logvar_d)
+        z = mu_d + scale * torch.randn_like(mu_d)
+        z = z.view(-1, 3, 32, 32)
+
+        x, _ = net(z, reverse=True)
+        outs.append(torch.sigmoid(x).cpu())
+
+    return torch.cat(outs, 0)
+
+
+def state_dict_to_cpu(state_dict):
+    """Copy `state_dict` into pinned host tensors, so it can be saved by
+    another thread. The copies are issued asynchronously, then awaited once."""
+    state_cpu = {}
+    for k, v in state_dict.items():
+        if v.is_cuda:
+            state_cpu[k] = torch.empty_like(v, device='cpu', pin_memory=True).copy_(v, non_blocking=True)
+        else:
+            state_cpu[k] = v.detach().clone()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    return state_cpu
+
+
+@torch.inference_mode()
+def test(epoch, net, vae_net, testloader, device, loss_fn, num_samples, save_dir, vae_stream=None,
+         log_interval=50, save_recon_every=1):
+    global best_loss
+    # Shards may differ in length, so bypass the DDP wrapper and its collectives
+    model = net.module if isinstance(net, torch.nn.parallel.DistributedDataParallel) else net
+    model.eval()
+    loss_meter = util.AverageMeter()
+    with tqdm(total=len(testloader.sampler), disable=not util.is_main_process()) as progress_bar:
+        for step, (x, _, *posterior) in enumerate(testloader):
+            # Copy the whole (B, 2, D) posterior, slicing on the CPU would break the async copy
+            x, posterior = to_device(x, posterior, device)
+            posterior = [t[:, 0] for t in posterior]
+            loss = compute_loss(model, vae_net, x, posterior, loss_fn, vae_stream=vae_stream)
+
+            loss_meter.update(loss, x.size(0))
+            if step % log_interval == 0 or step + 1 == len(testloader):
+                progress_bar.set_postfix(nll=loss_meter.avg,
+                                         bpd=util.bits_per_dim(x, loss_meter.avg))
             progress_bar.update(x.size(0))
 
-        x_, _ = net(x, reverse=True)
-        reconstruction_images = torch.sigmoid(x_)
+    util.all_reduce_meter(loss_meter, device)
+    if not util.is_main_process():
+        return
 
     # Save checkpoint
     print('best_loss ', best_loss)
@@ -179,27 +436,36 @@ def test(epoch, net, vae_net, testloader, device, loss_fn, num_samples, save_dir
     if loss_meter.avg < best_loss:
         best_loss = loss_meter.avg
 
-    print('Saving...')
-    state = {
-        'net': net.state_dict(),
-        'test_loss': loss_meter.avg,
-        'epoch': epoch,
-    }
-    os.makedirs('ckpts', exist_ok=True)
-    torch.save(state, 'ckpts/flow++_' + str(epoch) + 'vae(n_d_n_l_64).pth.tar')
+        print('Saving...')
+        state = {
+            'net': state_dict_to_cpu(model.state_dict()),
+            'test_loss': loss_meter.avg,
+            'epoch': epoch,
+        }
+        os.makedirs('ckpts', exist_ok=True)
+        submit_io(torch.save, state, 'ckpts/flow++_' + str(epoch) + 'vae(n_d_n_l_64).pth.tar')
 
     # Save reconstruction images
-    images = reconstruction_images
-    os.makedirs('samples', exist_ok=True)
-    images_concat = torchvision.utils.make_grid(images, nrow=int(num_samples ** 0.5), padding=2, pad_value=255)
-    torchvision.utils.save_image(images_concat, 'samples/reconstruction_epoch_{}.png'.format(epoch))
+    if epoch % save_recon_every == 0:
+        x_, _ = model(x, reverse=True)
+        images = torch.sigmoid(x_)
+        os.makedirs('samples', exist_ok=True)
+        save_grid(images, 'samples/reconstruction_epoch_{}.png'.format(epoch), num_samples)
 
     # Save samples and data
-    images = sample(net, vae_net, num_samples, device)
+    images = sample(model, vae_net, num_samples, device, chunk_size=testloader.batch_size)
     os.makedirs(save_dir, exist_ok=True)
-    images_concat = torchvision.utils.make_grid(images, nrow=int(num_samples ** 0.5), padding=2, pad_value=255)
-    torchvision.utils.save_image(images_concat,
-                                 os.path.join(save_dir, 'epoch_{}.png'.format(epoch)))
+    save_grid(images, os.path.join(save_dir, 'epoch_{}.png'.format(epoch)), num_samples)
+
+
+def save_grid(images, path, num_samples):
+    """Save `images` as a square grid on a background thread."""
+    def save(images_cpu):
+        images_concat = torchvision.utils.make_grid(images_cpu, nrow=int(num_samples ** 0.5), padding=2,
+                                                    pad_value=255)
+        torchvision.utils.save_image(images_concat, path)
+
+    submit_io(save, images.detach().cpu())
 
 
 if __name__ == '__main__':
@@ -208,9 +474,15 @@ if __name__ == '__main__':
     def str2bool(s):
         return s.lower().startswith('t')
 
-    parser.add_argument('--batch_size', default=4, type=int, help='Batch size per GPU')
-    parser.add_argument('--benchmark', type=str2bool, default=True, help='Turn on CUDNN benchmarking')
-    parser.add_argument('--gpu_ids', default=[0], type=eval, help='IDs of GPUs to use')
+    parser.add_argument('--batch_size', default=4, type=int, help='Batch size per GPU (one process per GPU)')
+    parser.add_argument('--benchmark', type=str2bool, default=True,
+                        help='Turn on CUDNN benchmarking (otherwise use deterministic algorithms)')
+    parser.add_argument('--gpu_ids', default=[0], type=eval,
+                        help='IDs of GPUs to use (launch with torchrun for multi-GPU)')
+    parser.add_argument('--grad_accum_steps', default=1, type=int,
+                        help='Number of batches to accumulate gradients over per optimizer step')
+    parser.add_argument('--log_interval', default=50, type=int,
+                        help='Number of batches between progress bar loss updates')
     parser.add_argument('--lr', default=1e-3, type=float, help='Peak learning rate')
     parser.add_argument('--max_grad_norm', type=float, default=1., help='Max gradient norm for clipping')
     parser.add_argument('--drop_prob', type=float, default=0.2, help='Dropout probability')
@@ -221,21 +493,39 @@ if __name__ == '__main__':
     parser.add_argument('--num_epochs', default=100, type=int, help='Number of epochs to train')
     parser.add_argument('--num_samples', default=64, type=int, help='Number of samples at test time')
     parser.add_argument('--num_workers', default=4, type=int, help='Number of data loader threads')
+    parser.add_argument('--prefetch_factor', default=4, type=int,
+                        help='Number of batches loaded in advance by each data loader worker')
     parser.add_argument('--resume', type=str2bool, default=False, help='Resume from checkpoint')
     parser.add_argument('--seed', type=int, default=0, help='Random seed for reproducibility')
+    parser.add_argument('--save_recon_every', type=int, default=1,
+                        help='Number of epochs between saving reconstructions of a test batch')
     parser.add_argument('--save_dir', type=str, default='samples', help='Directory for saving samples')
+    parser.add_argument('--use_amp', type=str2bool, default=True, help='Use bfloat16 mixed precision on CUDA')
     parser.add_argument('--use_attn', type=str2bool, default=True, help='Use attention in the coupling layers')
     parser.add_argument('--warm_up', type=int, default=200, help='Number of batches for LR warmup')
     parser.add_argument('--weight_decay', default=5e-5, type=float,
                         help='L2 regularization (only applied to the weight norm scale factors)')
 
+    parser.add_argument('--use_cuda_graph', type=str2bool, default=False,
+                        help='Replay the training step from a CUDA graph (single GPU only)')
+    parser.add_argument('--use_compile', type=str2bool, default=True,
+                        help='Compile Flow++ and the VAE decoder with torch.compile on CUDA')
+    parser.add_argument('--use_vae_cache', type=str2bool, default=True,
+                        help='Cache the VAE posterior of each image instead of re-encoding it every epoch')
+    parser.add_argument('--vae_cache_dir', type=str, default='data/vae_cache', help='Directory for the VAE cache')
     parser.add_argument('--vae_model_path', default="vae_ckpts/vae_n_decoder_n_latent_cifar_model_0501.pt",
                        type=str, help='')
     parser.add_argument('--vae_optim_path', default="vae_n_decoder_n_latent_cifar_optim_0501.pt",
                         type=str, help='')
 
-    best_loss = 0
+    best_loss = float('inf')
     global_step = 0
 
     print(torch.__version__)
-    main(parser.parse_args())
+    try:
+        main(parser.parse_args())
+    finally:
+        try:
+            wait_io()
+        finally:
+            io_pool.shutdown(wait=True)
@@ -1,4 +1,6 @@
 from util.array_util import *
+from util.dist_util import *
+from util.graph_util import *
 from util.norm_util import *
 from util.optim_util import *
 from util.shell_util import *
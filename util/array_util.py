@@ -1,8 +1,24 @@
+import functools
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+class ToUint8Tensor(object):
+    """Convert a PIL image to a uint8 tensor of shape (C, H, W).
+
+    Unlike `torchvision.transforms.ToTensor`, values are not scaled to
+    (0, 1), so batches are 4x smaller to copy to the device. Convert them
+    there with `x.float().div_(255.)`.
+    """
+    def __call__(self, img):
+        x = torch.from_numpy(np.array(img, dtype=np.uint8, copy=True))
+        if x.dim() == 2:
+            x = x.unsqueeze(-1)
+        return x.permute(2, 0, 1).contiguous()
+
+
 class Flip(nn.Module):
     def forward(self, x, sldj, reverse=False):
         assert isinstance(x, tuple) and len(x) == 2
@@ -45,17 +61,7 @@ def checkerboard(x, reverse=False):
         b, c, h, w = x.size()
         device = x.device
 
-    # Get list of indices in alternating checkerboard pattern
-    y_idx = []
-    z_idx = []
-    for i in range(h):
-        for j in range(w):
-            if (i % 2) == (j % 2):
-                y_idx.append(i * w + j)
-            else:
-                z_idx.append(i * w + j)
-    y_idx = torch.tensor(y_idx, dtype=torch.int64, device=device)
-    z_idx = torch.tensor(z_idx, dtype=torch.int64, device=device)
+    y_idx, z_idx = _checkerboard_idx(h, w, device)
 
     if reverse:
         y, z = (t.contiguous().view(b, c, h * w // 2) for t in x)
@@ -76,6 +82,29 @@ def checkerboard(x, reverse=False):
         return y, z
 
 
+@functools.lru_cache(maxsize=None)
+def _checkerboard_idx(h, w, device):
+    """Get the indices of each half of an `h` x `w` checkerboard. Cached, so
+    the index tensors are only built (and copied to `device`) once.
+
+    Built outside inference mode, since the same tensors are later used for
+    indexing in autograd-recorded training steps.
+    """
+    with torch.inference_mode(False):
+        y_idx = []
+        z_idx = []
+        for i in range(h):
+            for j in range(w):
+                if (i % 2) == (j % 2):
+                    y_idx.append(i * w + j)
+                else:
+                    z_idx.append(i * w + j)
+        y_idx = torch.tensor(y_idx, dtype=torch.int64, device=device)
+        z_idx = torch.tensor(z_idx, dtype=torch.int64, device=device)
+
+    return y_idx, z_idx
+
+
 def channelwise(x, reverse=False):
     """Split x channel-wise."""
     if reverse:
@@ -0,0 +1,78 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.utils.data as data
+
+
+def init_distributed():
+    """Initialize the default process group if launched with `torchrun`.
+
+    Each process drives a single GPU, selected by the `LOCAL_RANK` variable
+    set by the launcher. Without a launcher this is a single-process no-op.
+
+    Returns:
+        rank (int): Global rank of this process.
+        local_rank (int): Index of the GPU used by this process.
+        world_size (int): Total number of processes.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 0, 1
+
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl')
+
+    return rank, local_rank, world_size
+
+
+def get_rank():
+    """Get the global rank of this process (0 if not distributed)."""
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    """Get the number of processes (1 if not distributed)."""
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process():
+    """Whether this process should log and write checkpoints/samples."""
+    return get_rank() == 0
+
+
+class ShardedSampler(data.Sampler):
+    """Split a dataset across processes in order, without padding.
+
+    Unlike `DistributedSampler`, no samples are repeated to even out the
+    shards, so that statistics summed with `all_reduce_meter` are exact.
+    Shards may differ in length by one sample.
+
+    Args:
+        dataset (torch.utils.data.Dataset): Dataset to sample from.
+    """
+    def __init__(self, dataset):
+        self.indices = range(get_rank(), len(dataset), get_world_size())
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def all_reduce_meter(meter, device):
+    """Sum the statistics of an `AverageMeter` across all processes.
+
+    Args:
+        meter (util.AverageMeter): Meter holding this process's statistics.
+        device (torch.device or str): Device to use for the collective.
+    """
+    if not dist.is_initialized():
+        return
+
+    stats = torch.tensor([0., meter.count], dtype=torch.float64, device=device)
+    stats[0] = meter.sum
+    dist.all_reduce(stats)
+    meter.sum, meter.count = stats.tolist()
@@ -0,0 +1,61 @@
+import torch
+
+
+class CUDAGraphStep(object):
+    """Training step captured once in a CUDA graph and replayed for every batch.
+
+    Replaying the graph launches all kernels of forward, backward and optimizer
+    step at once, instead of one by one from Python. This requires fixed input
+    shapes and a step without host synchronization (e.g., no `GradScaler`).
+
+    Adapted from: https://pytorch.org/docs/stable/notes/cuda.html#whole-network-capture
+
+    Args:
+        step_fn (callable): Runs one step on the given tensors, returns the loss.
+        optimizer (torch.optim.Optimizer): Optimizer stepped by `step_fn`.
+            Must be created with `capturable=True`.
+        example_inputs (list): Tensors of a real batch, used for the warm-up
+            steps (which also initialize data-dependent layers) and the capture.
+        num_warmup (int): Number of eager steps to run before capturing.
+    """
+    def __init__(self, step_fn, optimizer, example_inputs, num_warmup=3):
+        self.static_inputs = [t.clone() for t in example_inputs]
+
+        # The graph reads the LR from the tensors in place at capture, so hold on to them
+        self.optimizer = optimizer
+        self.static_lrs = [torch.tensor(float(group['lr']), device='cuda')
+                           for group in optimizer.param_groups]
+        self.sync_lr()
+
+        # Warm up on a side stream, as required before capture
+        warmup_stream = torch.cuda.Stream()
+        warmup_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(warmup_stream):
+            for _ in range(num_warmup):
+                optimizer.zero_grad(set_to_none=True)
+                step_fn(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+        # Gradients get allocated from the graph's memory pool during capture
+        optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_loss = step_fn(*self.static_inputs)
+
+    def __call__(self, *inputs):
+        for static_input, x in zip(self.static_inputs, inputs):
+            static_input.copy_(x, non_blocking=True)
+        self.graph.replay()
+
+        return self.static_loss
+
+    def sync_lr(self):
+        """Copy the LR set by a scheduler into the captured LR tensors.
+
+        Schedulers may replace `group['lr']` instead of filling it in place,
+        which the graph would never see. Call this after every scheduler step.
+        """
+        for group, static_lr in zip(self.optimizer.param_groups, self.static_lrs):
+            if group['lr'] is not static_lr:
+                static_lr.fill_(group['lr'])
+                group['lr'] = static_lr
@@ -1,8 +1,6 @@
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.utils as utils
-from torch.distributions import Independent, Normal
 
 
 def bits_per_dim(x, nll):
@@ -22,18 +20,6 @@ def bits_per_dim(x, nll):
     return bpd
 
 
-def clip_grad_norm(optimizer, max_norm, norm_type=2):
-    """Clip the norm of the gradients for all parameters under `optimizer`.
-
-    Args:
-        optimizer (torch.optim.Optimizer):
-        max_norm (float): The maximum allowable norm of gradients.
-        norm_type (int): The type of norm to use in computing gradient norms.
-    """
-    for group in optimizer.param_groups:
-        utils.clip_grad_norm_(group['params'], max_norm, norm_type)
-
-
 class NLLLoss(nn.Module):
     """Negative log-likelihood loss assuming isotropic gaussian with unit norm.
 
@@ -56,9 +42,11 @@ class NLLLoss(nn.Module):
         # dist = LowRankMultivariateNormal(mu_d, u_d.view(-1, u_d.shape[1], 1), sigma)
         # d = dist.log_prob(z.view(-1, z.shape[2] * z.shape[2] * self.color_channels))
 
-        # vae both n
-        dist = Independent(Normal(loc=mu_d, scale=torch.exp(logvar_d)), 1)
-        d = dist.log_prob(z.view(-1, z.shape[2] * z.shape[2] * self.color_channels))
+        # vae both n: log density of Independent(Normal(mu_d, exp(logvar_d)), 1),
+        # written out so `log(scale)` is just `logvar_d` (the decoder outputs log sigma)
+        z = z.reshape(-1, z.shape[2] * z.shape[2] * self.color_channels)
+        d = -0.5 * ((z - mu_d) * torch.exp(-logvar_d)) ** 2 - logvar_d - 0.5 * np.log(2 * np.pi)
+        d = d.sum(-1)
 
         # last
         # prior_ll = -0.5 * (z ** 2 + np.log(2 * np.pi))
@@ -67,7 +55,7 @@ class NLLLoss(nn.Module):
         # ll = prior_ll + sldj
 
         prior_ll = d \
-                   - np.log(self.k) * np.prod(z.size()[1:])
+                   - np.log(self.k) * z.size(1)
         ll = prior_ll + sldj
 
         nll = -ll.mean()
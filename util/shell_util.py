@@ -1,22 +1,36 @@
+import torch
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value.
 
+    Values may be tensors, in which case the running sum stays on their
+    device and is only copied to the host when `avg` is read.
+
     Adapted from: https://github.com/pytorch/examples/blob/master/imagenet/train.py
     """
     def __init__(self):
         self.val = 0.
-        self.avg = 0.
         self.sum = 0.
         self.count = 0.
 
     def reset(self):
         self.val = 0.
-        self.avg = 0.
         self.sum = 0.
         self.count = 0.
 
     def update(self, val, n=1):
+        if isinstance(val, torch.Tensor):
+            val = val.detach().to(torch.float64)
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return 0.
+        avg = self.sum / self.count
+        if isinstance(avg, torch.Tensor):
+            avg = avg.item()
+        return avg
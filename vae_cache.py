@@ -0,0 +1,113 @@
+"""Cache the VAE posterior of every CIFAR-10 image.
+
+The VAE is frozen while training Flow++, and its encoder is deterministic in
+eval mode, so the posterior `(mu, logvar)` of each image never changes. Only
+the latent sample and the decoder have to run per batch.
+"""
+import hashlib
+import json
+import numpy as np
+import os
+import torch
+import torch.utils.data as data
+import torchvision
+import torchvision.transforms as transforms
+from PIL import Image
+
+SPLITS = {'train': True, 'test': False}
+META_FILE = 'meta.json'
+
+
+def cache_dir_for(root, vae_model_path):
+    """Get the cache directory for the VAE weights at `vae_model_path`."""
+    name = os.path.splitext(os.path.basename(vae_model_path))[0]
+    return os.path.join(root, name)
+
+
+def vae_checksum(vae_model_path, chunk_size=1 << 20):
+    """Get the SHA-256 of the VAE weights at `vae_model_path`."""
+    sha = hashlib.sha256()
+    with open(vae_model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def is_cache_valid(cache_dir, vae_model_path):
+    """Check that `cache_dir` holds a complete cache built from the VAE weights
+    at `vae_model_path`, rather than from other weights with the same file name."""
+    try:
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get('vae_sha256') == vae_checksum(vae_model_path)
+
+
+@torch.no_grad()
+def build_vae_cache(vae_net, vae_model_path, data_root, cache_dir, device, batch_size=256):
+    """Encode CIFAR-10 with `vae_net` and save the posteriors under `cache_dir`.
+
+    For each split, writes `<split>_mu.npy` and `<split>_logvar.npy` of shape
+    (N, 2, D), where index 1 of the second axis holds the posterior of the
+    horizontally flipped image. The checksum of the weights is written last
+    to `meta.json`, so `is_cache_valid` rejects stale or incomplete caches.
+
+    Args:
+        vae_net (torch.nn.Module): VAE in eval mode, with an `encode` method.
+        vae_model_path (str): Path of the weights loaded into `vae_net`.
+        data_root (str): Root directory of the CIFAR-10 dataset.
+        cache_dir (str): Directory to write the cache to.
+        device (torch.device or str): Device to run `vae_net` on.
+        batch_size (int): Number of images to encode at once.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for split, train in SPLITS.items():
+        dataset = torchvision.datasets.CIFAR10(root=data_root, train=train, download=True,
+                                               transform=transforms.ToTensor())
+        loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+        mus, logvars = [], []
+        for x, _ in loader:
+            x = x.to(device)
+            mu, logvar = zip(*(vae_net.encode(x_) for x_ in (x, torch.flip(x, dims=[-1]))))
+            mus.append(torch.stack(mu, dim=1).cpu())
+            logvars.append(torch.stack(logvar, dim=1).cpu())
+
+        np.save(os.path.join(cache_dir, '{}_mu.npy'.format(split)), torch.cat(mus).numpy())
+        np.save(os.path.join(cache_dir, '{}_logvar.npy'.format(split)), torch.cat(logvars).numpy())
+
+    with open(meta_path, 'w') as f:
+        json.dump({'vae_sha256': vae_checksum(vae_model_path)}, f)
+
+
+class VAECachedCIFAR10(torchvision.datasets.CIFAR10):
+    """CIFAR-10 that also returns the cached VAE posterior of each image.
+
+    The posteriors have shape (2, D): one for the image and one for its
+    horizontal flip, so that random flips can be applied later on the device.
+
+    Args:
+        root (str): Root directory of the CIFAR-10 dataset.
+        cache_dir (str): Directory written by `build_vae_cache`.
+        train (bool): Use the training split.
+    """
+    def __init__(self, root, cache_dir, train=True, **kwargs):
+        super(VAECachedCIFAR10, self).__init__(root, train=train, **kwargs)
+        split = 'train' if train else 'test'
+        self.mu = np.load(os.path.join(cache_dir, '{}_mu.npy'.format(split)), mmap_mode='r')
+        self.logvar = np.load(os.path.join(cache_dir, '{}_logvar.npy'.format(split)), mmap_mode='r')
+
+    def __getitem__(self, index):
+        img, target = Image.fromarray(self.data[index]), self.targets[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+
+        mu = torch.from_numpy(np.array(self.mu[index]))
+        logvar = torch.from_numpy(np.array(self.logvar[index]))
+
+        return img, target, mu, logvar
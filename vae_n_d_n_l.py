@@ -38,7 +38,7 @@ class Encoder(nn.Module):
 
     def forward(self, x):
         out = self.m3(self.m2(self.m1(self.bottle(x))))
-        return out.view(-1, self.n_neurons_in_middle_layer)
+        return out.reshape(-1, self.n_neurons_in_middle_layer)
 
 
 class DecoderModule(nn.Module):
@@ -134,7 +134,7 @@ class VAE(nn.Module):
 
     def _reparameterize(self, mu, logvar):
         std = logvar.mul(0.5).exp_()
-        esp = torch.randn(*mu.size()).to(self.device)
+        esp = torch.randn_like(mu)
         z = mu + std * esp
         return z
 
@@ -144,19 +144,31 @@ class VAE(nn.Module):
         return z, mu, logvar
 
     def decoder_bottleneck(self, d):
+        # `logvar` of the decoder is used as log sigma (scale = exp(logvar))
         mu, logvar = self.fc5(d), self.fc6(d)
         return mu, logvar
 
-    def forward(self, x):
-        # Encoder
+    def encode(self, x):
+        # Encoder (deterministic in eval mode)
         h = self.encoder(x)
+        mu, logvar = self.fc1(h), self.fc2(h)
+        return mu, logvar
+
+    def decode_params(self, mu, logvar):
         # Bottle-neck
-        z, mu, logvar = self._bottleneck(h)
+        z = self._reparameterize(mu, logvar)
         # decoder
         z = self.fc4(z)
         d = self.decoder(z)
         d_ = d.view(-1, self.n_neurons_last_decoder_layer)
         mu_d, logvar_d = self.decoder_bottleneck(d_)
+        return mu_d, logvar_d
+
+    def forward(self, x, return_posterior=True):
+        mu, logvar = self.encode(x)
+        mu_d, logvar_d = self.decode_params(mu, logvar)
+        if not return_posterior:
+            return mu_d, logvar_d
         return mu_d, logvar_d, mu, logvar
 
     def init_model(self):
@@ -164,5 +176,4 @@ class VAE(nn.Module):
 
         if self.device == "cuda":
             self = self.cuda()
-            torch.backends.cudnn.benchmark = True
         self.to(self.device)
\ No newline at end of file